@@ -4,35 +4,77 @@ import numpy as np
 import cv2
 import colorbalance
 import os
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait
 
-def Color_correct_and_write(card,image,study_file_name, Acc):
-    
+# Corrected images are encoded and written by background threads, so that the
+# next image can be processed meanwhile. At most MAX_PENDING_WRITES images are
+# held in memory waiting to be written.
+MAX_PENDING_WRITES = 2
+_writer = ThreadPoolExecutor(max_workers = MAX_PENDING_WRITES)
+_pending_writes = []
+
+# number of fits tried on a well detected card before giving up on a high
+# correction error, and the standard deviation of the noise added to the
+# card colors between fits
+MAX_FIT_ATTEMPTS = 5
+FIT_PERTURBATION = 5.
+
+# OpenCV's default JPEG quality
+JPEG_QUALITY = 95
+
+def write_image(study_file_name, image, jpeg_quality = JPEG_QUALITY):
+    ext = os.path.splitext(study_file_name)[1]
+    if ext.lower() in ('.jpg', '.jpeg'):
+        params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality, cv2.IMWRITE_JPEG_OPTIMIZE, 0, cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+    elif ext.lower() == '.png':
+        # fastest zlib level; PNG is lossless at any level
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+    else:
+        params = []
+    encoded, buf = cv2.imencode(ext, image, params)
+    if not encoded:
+        raise IOError("could not encode image '%s'" % study_file_name)
+    with open(study_file_name, 'wb') as f:
+        f.write(buf.tobytes())
+
+def write_image_async(study_file_name, image, jpeg_quality = JPEG_QUALITY):
+    # Returns the future of the write; its result, or error, belongs to this
+    # image only and has to be checked by the caller.
+    if len(_pending_writes) >= MAX_PENDING_WRITES:
+        wait([_pending_writes.pop(0)])
+    future = _writer.submit(write_image, study_file_name, image, jpeg_quality)
+    _pending_writes.append(future)
+    return future
+
+def wait_for_writes():
+    # block until every queued image is written (errors are left to the
+    # futures returned by write_image_async)
+    wait(_pending_writes)
+    del _pending_writes[:]
+
+@functools.lru_cache(maxsize = 32)
+def _fit_card(card_bytes, dtype, shape, Acc):
+    card = np.frombuffer(card_bytes, dtype = dtype).reshape(shape)
     card_damaged = False
     card_rotated = False
     correction_error = 0
     
     CardRGB = cv2.cvtColor(card, cv2.COLOR_BGR2RGB)
-    ImageRGB = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     actual_colors, actual_colors_std = colorbalance.get_colorcard_colors(CardRGB,grid_size=[6, 4])
     
-    if any(actual_colors_std>90):
+    if np.any(actual_colors_std > 90):
         card_damaged = True
-        return card_damaged, card_rotated, correction_error
+        return None, None, None, correction_error, card_rotated, card_damaged
         # we can comment the above return and use the following two lines if we want to color correct regardless of the corrupted colors
         # actual_colors = np.delete(actual_colors,np.where(actual_colors_std>90),1)
         # true_colors = np.delete(true_colors,np.where(actual_colors_std>90),1)
 
     
-    cnt_color = 0
-    # comparing yellow and light red, yellow should have larger value
-    if np.sum(actual_colors[:, 8])> np.sum(actual_colors[:, -9]): 
-        cnt_color = cnt_color + 1
-    # comparing white and blue-green, white should have larger value
-    if np.sum(actual_colors[:, 5])> np.sum(actual_colors[:, -6]): 
-        cnt_color = cnt_color + 1
-    # comparing black and dark tone, black should have smaller value
-    if np.sum(actual_colors[:, 0])< np.sum(actual_colors[:, -1]): 
-        cnt_color = cnt_color + 1
+    sums = actual_colors.sum(0)
+    cnt_color = (int(sums[8] > sums[-9])     # comparing yellow and light red, yellow should have larger value
+                 + int(sums[5] > sums[-6])   # comparing white and blue-green, white should have larger value
+                 + int(sums[0] < sums[-1]))  # comparing black and dark tone, black should have smaller value
     # If two or more of the above conditions are met, card is then rotated
     if cnt_color >= 2:
         actual_colors = actual_colors[:, ::-1]
@@ -42,33 +84,58 @@ def Color_correct_and_write(card,image,study_file_name, Acc):
     true_colors = colorbalance.ColorCheckerRGB_CameraTrax
    
   
-    iter = 0
+    # Sometimes, although card detection is OK (Acc is high), optimization for
+    # color correction fails (high error). In this case, actual_colors are changed
+    # slightly and correction is repeated, keeping the best fit. The perturbations
+    # come from a generator seeded per call, so that a card always gives the same result
+    rng = np.random.default_rng(0)
     actual_colors2 = actual_colors
-    Check = True
-    while Check:
-        iter = iter + 1
-        color_alpha, color_constant, color_gamma = colorbalance.get_color_correction_parameters(true_colors,actual_colors2,'gamma_correction')
-        corrected_colors = colorbalance._gamma_correction_model(actual_colors2, color_alpha, color_constant, color_gamma)
+    best = None
+    for iter in range(MAX_FIT_ATTEMPTS):
+        params = colorbalance.get_color_correction_parameters(true_colors,actual_colors2,'gamma_correction')
+        corrected_colors = colorbalance._gamma_correction_model(actual_colors2, *params)
         diff_colors = true_colors - corrected_colors
-        errors = np.sqrt(np.sum(diff_colors * diff_colors, axis=0)).tolist()
-        # Sometimes, although card detection is OK (Acc is high), optimization for
-        # color corection fails (high error). In this case, actual_colors are changed
-        # slightly an dcorrection is repeated 
-        if Acc > 0.4 and np.mean(errors) > 40 and iter < 6:
-            actual_colors2 = actual_colors + np.random.rand(3,24)
-            # print('   Corrction error high, correcting again....!')
-        else:
-            Check = False
+        errors = np.sqrt(np.sum(diff_colors * diff_colors, axis=0))
+        if best is None or np.mean(errors) < np.mean(best[1]):
+            best = (params, errors)
+        if Acc <= 0.4 or np.mean(errors) <= 40:
+            break
+        actual_colors2 = actual_colors + rng.standard_normal((3,24)) * FIT_PERTURBATION
+    (color_alpha, color_constant, color_gamma), errors = best
    
     correction_error = round((np.mean(errors)/255)*10000)/float(100)
 
-    if correction_error < 50:  # equivalent to 20% error
-        ImageRGBCorrected = colorbalance.correct_color(ImageRGB, color_alpha,color_constant, color_gamma)
-        # get back to RBG order for OpenCV
-        ImageCorrected = cv2.cvtColor(ImageRGBCorrected, cv2.COLOR_RGB2BGR)
-        if not os.path.exists(os.path.dirname(study_file_name)):
-            os.makedirs(os.path.dirname(study_file_name))
-        cv2.imwrite(study_file_name,ImageCorrected)
+    return color_alpha, color_constant, color_gamma, correction_error, card_rotated, card_damaged
+
+# Fits the correction parameters to the colors of the card. Cards cropped to
+# identical pixels (e.g. the same card reused for a batch of images) give the
+# same fit, so fits are cached on the card content.
+# Returns (alpha, constant, gamma, error, rotated, damaged); the parameters are
+# None if the card is damaged. The returned arrays are shared and must not be modified.
+def fit_card(card, Acc):
+    return _fit_card(card.tobytes(), card.dtype.str, card.shape, Acc)
+
+# Applies fitted parameters (alpha, constant, gamma) to a BGR image
+def apply_to_image(image, params):
+    color_alpha, color_constant, color_gamma = params
+    ImageRGB = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    ImageRGBCorrected = colorbalance.correct_color(ImageRGB, color_alpha,color_constant, color_gamma)
+    # get back to RBG order for OpenCV
+    return cv2.cvtColor(ImageRGBCorrected, cv2.COLOR_RGB2BGR)
+
+def Color_correct_and_write(card,image,study_file_name, Acc, jpeg_quality = JPEG_QUALITY):
     
-    return card_damaged, card_rotated, correction_error
+    # The last value returned is the future of the background write of the
+    # corrected image, or None if it is not written
+    write = None
+    color_alpha, color_constant, color_gamma, correction_error, card_rotated, card_damaged = fit_card(card, Acc)
+    if card_damaged:
+        return card_damaged, card_rotated, correction_error, write
 
+    if correction_error < 50:  # equivalent to 20% error
+        ImageCorrected = apply_to_image(image, (color_alpha, color_constant, color_gamma))
+        # pool workers may create the same folder at the same time
+        os.makedirs(os.path.dirname(study_file_name), exist_ok = True)
+        write = write_image_async(study_file_name,ImageCorrected, jpeg_quality)
+    
+    return card_damaged, card_rotated, correction_error, write
@@ -1,34 +1,158 @@
 import numpy as np
 import imutils
 import cv2
-from scipy import ndimage
-from joblib import Parallel, delayed
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-def paralell_search(search_scale, degree, gray, H_card, W_card, card):
-    found = None
-    if degree is not 0:
-        gray_rot = ndimage.rotate(gray, degree)
-    else:
-        gray_rot = gray
-    for i in range(len(search_scale)):
-
-        scale2 = search_scale[i]
-        # resize the image according to the scale, and keep track
-        # of the ratio of the resizing
-        resized = imutils.resize(gray_rot, width = int(gray.shape[1] * scale2))
-        r = gray_rot.shape[1] / float(resized.shape[1])
-        # if the resized image is smaller than the template, then break
-        # from the loop
-        if resized.shape[0] < H_card or resized.shape[1] < W_card:
+# pyramid_match searches the whole image only after PYRAMID_LEVELS halvings
+# (fewer if the template would get smaller than PYRAMID_MIN_SIZE pixels), then
+# refines the best PYRAMID_CANDIDATES peaks level by level inside a window of
+# PYRAMID_MARGIN pixels around them. Edge maps lose detail quickly when halved,
+# so one level is used, and images less than PYRAMID_MIN_RATIO times the area
+# of the template are searched directly.
+PYRAMID_LEVELS = 1
+PYRAMID_MIN_SIZE = 16
+PYRAMID_MIN_RATIO = 16
+PYRAMID_CANDIDATES = 5
+PYRAMID_MARGIN = 4
+
+# With coarse_to_fine, detect_card first searches every SEARCH_STEP-th degree
+# and scale (and the last ones), then climbs to the best neighbouring
+# (degree, scale) pairs until the best pair has no unsearched neighbour. This
+# is faster on large grids but can settle on a local maximum, so by default
+# every pair is searched.
+SEARCH_STEP = 2
+
+def cuda_enabled():
+    # OpenCV builds without CUDA either lack cv2.cuda or report no device
+    try:
+        return(cv2.cuda.getCudaEnabledDeviceCount() > 0)
+    except (AttributeError, cv2.error):
+        return(False)
+
+# template matching runs on the GPU when OpenCV was built with CUDA and a
+# device is present
+CUDA_ENABLED = cuda_enabled()
+
+# the GPU matcher and the uploaded templates of each search thread
+_cuda_state = threading.local()
+
+def match_template(image, template):
+    # cv2.TM_CCOEFF_NORMED correlation map of the template over the whole
+    # image, which is the coarse match of each search task. On the GPU the
+    # matcher and the template are set up once per thread, so only the image
+    # is uploaded. The small refinement windows stay on the CPU, where they
+    # cost less than an upload.
+    if CUDA_ENABLED:
+        if not hasattr(_cuda_state, 'matcher'):
+            _cuda_state.matcher = cv2.cuda.createTemplateMatching(cv2.CV_8UC1, cv2.TM_CCOEFF_NORMED)
+            _cuda_state.templates = {}
+        # the template is kept with its upload so that its id is not reused
+        (_, template_gpu) = _cuda_state.templates.get(id(template), (None, None))
+        if template_gpu is None:
+            template_gpu = cv2.cuda_GpuMat()
+            template_gpu.upload(template)
+            _cuda_state.templates[id(template)] = (template, template_gpu)
+        image_gpu = cv2.cuda_GpuMat()
+        image_gpu.upload(image)
+        return(_cuda_state.matcher.match(image_gpu, template_gpu).download())
+    return(cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED))
+
+def template_pyramid(template):
+    # the template pyramid only depends on the card, so it is built once
+    # and shared, read-only, by every search task
+    template_pyr = [template]
+    for level in range(PYRAMID_LEVELS):
+        if min(template_pyr[-1].shape[:2]) < 2 * PYRAMID_MIN_SIZE:
             break
-        # apply template matching to find the template in the image 
-        result = cv2.matchTemplate(resized, card, cv2.TM_CCOEFF_NORMED)
+        template_pyr.append(cv2.pyrDown(template_pyr[-1]))
+    return(template_pyr)
+
+def ncc_same_size(image, template):
+    # cv2.TM_CCOEFF_NORMED of two images of the same size, which has a
+    # single position and does not need cv2.matchTemplate's setup
+    a = image.astype(np.float32)
+    b = template.astype(np.float32)
+    a -= a.mean()
+    b -= b.mean()
+    norm_b = np.dot(b.ravel(), b.ravel())
+    norm_a = np.dot(a.ravel(), a.ravel())
+    # same convention as OpenCV for flat images
+    if norm_b == 0:
+        return(1.0)
+    if norm_a == 0:
+        return(0.0)
+    return(float(np.dot(a.ravel(), b.ravel()) / np.sqrt(norm_a * norm_b)))
+
+def match_window(window, template):
+    # best match of the template inside a window of the image.
+    # cv2.matchTemplate already takes the TM_CCOEFF_NORMED window sums from
+    # integral images, and the image differs for every (degree, scale) task,
+    # so there are no integral images to share between calls
+    if window.shape == template.shape:
+        return((ncc_same_size(window, template), (0, 0)))
+    result = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+    (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
+    return((maxVal, maxLoc))
+
+def pyramid_match(image, template_pyr):
+    if image.shape == template_pyr[0].shape:
+        return(match_window(image, template_pyr[0]))
+    # build the image pyramid, as deep as the template pyramid allows
+    image_pyr = [image]
+    while len(image_pyr) < len(template_pyr):
+        if image_pyr[-1].size < PYRAMID_MIN_RATIO * template_pyr[len(image_pyr) - 1].size:
+            break
+        image_pyr.append(cv2.pyrDown(image_pyr[-1]))
+    template_pyr = template_pyr[:len(image_pyr)]
+    # exhaustive search at the coarsest level, keeping the strongest peaks;
+    # this is the only level uploaded to the GPU, once per task.
+    # cv2.matchTemplate switches to DFT correlation by itself for large
+    # templates; a scipy rfft2 path measured no faster on these sizes even
+    # before normalisation
+    result = match_template(image_pyr[-1], template_pyr[-1])
+    (H_tmp, W_tmp) = template_pyr[-1].shape[:2]
+    found = []
+    for i in range(PYRAMID_CANDIDATES):
         (_, maxVal, _, maxLoc) = cv2.minMaxLoc(result)
-        # if we have found a new maximum correlation value, then update
-        # the bookkeeping variable
-        if found is None or maxVal > found[0]:
-            found = (maxVal, maxLoc, r, scale2)
-    return(found)
+        found.append((maxVal, maxLoc))
+        # suppress the neighbourhood of this peak before looking for the next
+        (x, y) = maxLoc
+        result[max(0, y - H_tmp // 2):y + H_tmp // 2 + 1, max(0, x - W_tmp // 2):x + W_tmp // 2 + 1] = -1
+    # refine the peaks at each finer level, only around their previous location
+    for level in range(len(image_pyr) - 2, -1, -1):
+        gray = image_pyr[level]
+        (H_tmp, W_tmp) = template_pyr[level].shape[:2]
+        refined = []
+        for (_, (x, y)) in found:
+            x_start = max(0, 2 * x - PYRAMID_MARGIN)
+            y_start = max(0, 2 * y - PYRAMID_MARGIN)
+            x_end = min(gray.shape[1], 2 * x + W_tmp + PYRAMID_MARGIN)
+            y_end = min(gray.shape[0], 2 * y + H_tmp + PYRAMID_MARGIN)
+            (maxVal, maxLoc) = match_window(gray[y_start:y_end, x_start:x_end], template_pyr[level])
+            refined.append((maxVal, (x_start + maxLoc[0], y_start + maxLoc[1])))
+        found = refined
+    return(max(found, key = lambda peak: peak[0]))
+
+def rotate_image(gray, degree):
+    if degree != 0:
+        return(imutils.rotate_bound(gray, degree))
+    return(gray)
+
+def paralell_search(scale2, gray_rot, width, H_card, W_card, card_pyr):
+    # resize the image according to the scale, and keep track
+    # of the ratio of the resizing
+    resized = imutils.resize(gray_rot, width = int(width * scale2))
+    r = gray_rot.shape[1] / float(resized.shape[1])
+    # if the resized image is smaller than the template, there is
+    # nothing to match at this scale
+    if resized.shape[0] < H_card or resized.shape[1] < W_card:
+        return(None)
+    # apply template matching to find the template in the image 
+    (maxVal, maxLoc) = pyramid_match(resized, card_pyr)
+    return((maxVal, maxLoc, r, scale2))
     
     
 # this function searches for color card ('card') in the image ('img').
@@ -36,29 +160,72 @@ def paralell_search(search_scale, degree, gray, H_card, W_card, card):
 # However, search_scale and search_degree can be passed to test ranges of different sizes and orientations
 # suggested ranges: [0.9,1.1] for search_scale and [-2.5,2.5] degree for search_degree
 
-def detect_card(img, card, search_scale, search_degree, num_cores):
+# card_pyr, the template pyramid of the card, can be given when several
+# images are searched for the same card, so that it is built only once
+
+def detect_card(img, card, search_scale, search_degree, num_cores, card_pyr = None, coarse_to_fine = False):
 
     (H_card, W_card) = card.shape[:2]
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    # detect edges in the grayscale image
+    # detect edges in the grayscale image, once for all tasks. Rotating and
+    # resizing the edge map softens the edges slightly, which makes matching
+    # against the (already edge-detected) card more tolerant; detecting edges
+    # after rotating and resizing gives lower correlations for the same card
+    # locations, pushing borderline images below the detection threshold.
     edged = cv2.Canny(gray,40,50)
-    # search for the best scale and rotation degree
-    results = Parallel(n_jobs = num_cores, backend = "threading")(delayed(paralell_search)(search_scale, degree, edged, H_card, W_card, card) for degree in search_degree)
-    maxVal_all, _, _, _  = zip(*results)
-    # select the best scale and rotation degree based on the maximum correlation
-    ind = np.argmax(maxVal_all)
-    maxVal, maxLoc, r, SCALE  = results[ind]
-    deg = search_degree[ind]
+    if card_pyr is None:
+        card_pyr = template_pyramid(card)
+    # negative num_cores count back from the number of cores, as in joblib:
+    # -1 uses all of them, -2 all but one, ...
+    if num_cores < 0:
+        num_cores = max(1, os.cpu_count() + 1 + num_cores)
+    # the pool already runs one task per core, so OpenCV should not start
+    # threads of its own inside each task
+    num_threads = cv2.getNumThreads()
+    if num_cores != 1:
+        cv2.setNumThreads(1)
+    try:
+        with ThreadPoolExecutor(max_workers = num_cores) as executor:
+            rotated = {}
+            results = {}
+            def search(tasks):
+                # search the given (degree index, scale index) pairs, every pair
+                # being a separate task
+                tasks = [task for task in tasks if task not in results]
+                # rotate the edges once per degree; all scales of a degree share it
+                degrees = sorted(set(i for i, j in tasks) - set(rotated))
+                rotated.update(zip(degrees, executor.map(rotate_image, itertools.repeat(edged), [search_degree[i] for i in degrees])))
+                results.update(zip(tasks, executor.map(lambda task: paralell_search(search_scale[task[1]], rotated[task[0]], edged.shape[1], H_card, W_card, card_pyr), tasks)))
+            def best():
+                # the best scale and rotation degree based on the maximum correlation
+                return(max(sorted(results), key = lambda task: -np.inf if results[task] is None else results[task][0]))
+            def coarse(n):
+                return(sorted(set(range(0, n, SEARCH_STEP)) | {n - 1}))
+            if not coarse_to_fine:
+                search(itertools.product(range(len(search_degree)), range(len(search_scale))))
+            else:
+                search(itertools.product(coarse(len(search_degree)), coarse(len(search_scale))))
+            while True:
+                (i, j) = best()
+                neighbours = [(i + di, j + dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)
+                              if 0 <= i + di < len(search_degree) and 0 <= j + dj < len(search_scale)]
+                if all(task in results for task in neighbours):
+                    break
+                search(neighbours)
+    finally:
+        cv2.setNumThreads(num_threads)
+    maxVal, maxLoc, r, SCALE  = results[(i, j)]
+    deg = search_degree[i]
     # obtain Colorcard locations
     (startX, startY) = (int(round(maxLoc[0]*r)), int(round(maxLoc[1]*r)))
     (endX, endY) = (int(round((maxLoc[0] + W_card)*r)), int(round((maxLoc[1] + H_card) * r)))
     # rotate image if obtained card was rotated
-    if deg is not 0:
-        output_img = ndimage.rotate(img, deg)
+    if deg != 0:
+        output_img = imutils.rotate_bound(img, deg, inter = cv2.INTER_CUBIC)
     else:
         output_img = img
-    # crop Colorcard
-    output_img = output_img[startY:endY,startX:endX,:]
+    # crop Colorcard, copied so that it does not share the buffer of 'img'
+    output_img = output_img[startY:endY,startX:endX,:].copy()
 
     return(output_img,maxVal,SCALE)
 
@@ -29,6 +29,7 @@ References
 """
 
 import numpy as np
+import cv2
 from scipy import optimize
 from scipy import stats
 
@@ -49,6 +50,16 @@ ColorCheckerRGB_XRite = np.asarray(
      [68., 130., 157., 67., 177., 170., 44., 166., 99., 108., 64., 46.,
       150., 73., 60., 31., 149., 161., 242., 200., 160., 121., 85., 52.]])
 
+# Bounds of the parameters searched by `get_color_correction_parameters`
+ALPHA_BOUNDS = (-10., 10.)
+CONSTANT_BOUNDS = (-255., 255.)
+GAMMA_BOUNDS = (0.2, 5.)
+# Maximum number of residual evaluations (about one per iteration) of the
+# parameter fit. The fit stops on least_squares' default tolerances; on the
+# test cards it needs 22-27 evaluations for `gamma_correction` and 200-380
+# for `classic_gamma_correction`, so this is only a safety net.
+MAX_ITERATIONS = 1000
+
 
 def _classic_gamma_correction_model(colors, color_alpha, color_constant,
                                     color_gamma):
@@ -91,17 +102,53 @@ def _gamma_correction_model(colors, color_alpha, color_constant,
     assert(color_gamma.size == 3)
 
     scaled_colors = np.dot(color_alpha, colors) + color_constant
-    np.clip(scaled_colors, 0, None, scaled_colors)  # set min values to zeros # I (MEF) commented this. This is now like the pipeline!!
-    corrected_colors = np.zeros_like(scaled_colors)
-    for j in range(3):
-        corrected_colors[j, :] = 255.0*np.power(scaled_colors[j, :]/255.0,
-                                                color_gamma[j])
+    # 255*(s/255)^gamma for all channels at once, as exp(gamma*log(s/255))
+    # evaluated in place; the lower bound stands in for clipping to zero
+    corrected_colors = scaled_colors
+    np.maximum(corrected_colors, 1e-8, out=corrected_colors)
+    np.multiply(corrected_colors, 1.0/255.0, out=corrected_colors)
+    np.log(corrected_colors, out=corrected_colors)
+    np.multiply(corrected_colors, color_gamma.reshape([3, 1]),
+                out=corrected_colors)
+    np.exp(corrected_colors, out=corrected_colors)
+    np.multiply(corrected_colors, 255.0, out=corrected_colors)
     return corrected_colors
 
 
-def _get_color_error(args2, true_colors, actual_colors, algorithm):
-    """Calculated color error after applying color correction.
-    This function is used in `get_color_correction_parameters` function.
+def _gamma_correction_lut(image, color_alpha, color_constant, color_gamma):
+    """Apply the modified gamma correction to an 8-bit image using OpenCV's
+    per-pixel matrix transform and a lookup table instead of per-pixel
+    matrix products and powers.
+
+    `cv2.transform` computes alpha * pixel + beta for an 8-bit image with
+    saturation, so its output is the scaled value clipped to [0, 255] and
+    rounded. Anything above 255 saturates to 255 after the power anyway,
+    so the gamma step is a 256-entry table per channel, applied with
+    `cv2.LUT`.
+
+    """
+    assert(image.shape[2] == 3)
+    assert(color_alpha.shape == (3, 3))
+    assert(color_constant.size == 3)
+    assert(color_gamma.size == 3)
+
+    # [alpha | beta], the 3x4 affine matrix of `cv2.transform`
+    matrix = np.hstack([color_alpha, color_constant.reshape([3, 1])])
+    # gamma_lut[s, 0, c] = 255*(s/255)^gamma_c
+    values = np.arange(256, dtype=np.float32)
+    gamma_lut = np.clip(255.0*np.power(values[:, np.newaxis]/255.0,
+                                       color_gamma.reshape([1, 3])),
+                        0, 255).astype(np.uint8)
+
+    corrected_image = cv2.transform(np.ascontiguousarray(image),
+                                    matrix.astype(np.float32))
+    return cv2.LUT(corrected_image, gamma_lut.reshape([256, 1, 3]),
+                   dst=corrected_image)
+
+
+def _get_corrected_colors(args2, actual_colors, algorithm):
+    """Apply the color correction given by the parameter vector `args2`.
+    This function is used by `_get_color_error` and `_get_color_residuals`.
 
     """
     if algorithm == "classic_gamma_correction":
@@ -109,23 +156,87 @@ def _get_color_error(args2, true_colors, actual_colors, algorithm):
         color_constant = args2[3:6].reshape([3, 1])
         # forced non-negative exponential component
         color_gamma = np.abs(args2[6:9].reshape([3, 1]))
-        corrected_colors = \
-            _classic_gamma_correction_model(actual_colors, color_alpha,
-                                            color_constant, color_gamma)
+        return _classic_gamma_correction_model(actual_colors, color_alpha,
+                                               color_constant, color_gamma)
     elif algorithm == "gamma_correction":
         color_alpha = args2[:9].reshape([3, 3])
         color_constant = args2[9:12].reshape([3, 1])
         # forced non-negative exponential component
         color_gamma = np.abs(args2[12:15].reshape([3, 1]))
+        return _gamma_correction_model(actual_colors, color_alpha,
+                                       color_constant, color_gamma)
+    else:
+        raise ValueError("Unsupported algorithm {}.".format(algorithm))
+
+
+def _get_color_error(args2, true_colors, actual_colors, algorithm):
+    """Calculated color error after applying color correction.
+
+    """
+    diff_colors = true_colors - \
+        _get_corrected_colors(args2, actual_colors, algorithm)
+    errors = np.sqrt(np.sum(diff_colors * diff_colors, axis=0)).tolist()
+    return errors
+
+
+def _get_color_residuals(args2, true_colors, actual_colors, algorithm):
+    """Calculate the per-channel color differences after applying color
+    correction, channel by channel. Their sum of squares is the sum of
+    squared color errors of `_get_color_error`, but unlike the errors they
+    are smooth in the parameters, which lets the optimiser converge.
+    This function is used in `get_color_correction_parameters` function.
+
+    """
+    return (_get_corrected_colors(args2, actual_colors, algorithm) -
+            true_colors).ravel()
+
+
+def _get_color_jacobian(args2, true_colors, actual_colors, algorithm):
+    """Calculate the Jacobian of `_get_color_residuals` with respect to the
+    correction parameters, one row per residual and one column per parameter.
+    This function is used in `get_color_correction_parameters` function.
+
+    """
+    # derivatives[c, i, p]: derivative of channel c of the i-th corrected
+    # color with respect to parameter p
+    derivatives = np.zeros([3, actual_colors.shape[1], args2.size])
+    if algorithm == "classic_gamma_correction":
+        color_alpha = args2[:3].reshape([3, 1])
+        color_gamma = np.abs(args2[6:9].reshape([3, 1]))
+        powered_colors = np.power(actual_colors, color_gamma)
+        # x^gamma * log(x) tends to zero with x
+        log_colors = np.log(np.where(actual_colors > 0, actual_colors, 1.0))
+        gamma_slope = color_alpha * powered_colors * log_colors * \
+            np.sign(args2[6:9]).reshape([3, 1])
+        for j in range(3):
+            derivatives[j, :, j] = powered_colors[j, :]
+            derivatives[j, :, 3 + j] = 1.0
+            derivatives[j, :, 6 + j] = gamma_slope[j, :]
+    elif algorithm == "gamma_correction":
+        color_alpha = args2[:9].reshape([3, 3])
+        color_constant = args2[9:12].reshape([3, 1])
+        color_gamma = np.abs(args2[12:15].reshape([3, 1]))
+        scaled_colors = np.dot(color_alpha, actual_colors) + color_constant
         corrected_colors = \
             _gamma_correction_model(actual_colors, color_alpha,
                                     color_constant, color_gamma)
+        # d(255*(s/255)^gamma)/ds = gamma * output / s, and zero where the
+        # model clips s at its lower bound
+        clipped = scaled_colors <= 1e-8
+        scaled_colors[clipped] = 1e-8
+        slope = np.where(clipped, 0.0,
+                         color_gamma * corrected_colors / scaled_colors)
+        gamma_slope = corrected_colors * np.log(scaled_colors / 255.0) * \
+            np.sign(args2[12:15]).reshape([3, 1])
+        for j in range(3):
+            derivatives[j, :, 3 * j:3 * j + 3] = \
+                (slope[j, :] * actual_colors).T
+            derivatives[j, :, 9 + j] = slope[j, :]
+            derivatives[j, :, 12 + j] = gamma_slope[j, :]
     else:
         raise ValueError("Unsupported algorithm {}.".format(algorithm))
 
-    diff_colors = true_colors - corrected_colors
-    errors = np.sqrt(np.sum(diff_colors * diff_colors, axis=0)).tolist()
-    return errors
+    return derivatives.reshape([-1, args2.size])
 
 
 def get_color_correction_parameters(true_colors, actual_colors,
@@ -157,10 +268,16 @@ def get_color_correction_parameters(true_colors, actual_colors,
     ValueError
         If the input algorithm is not supported.
     """
+    # the card colors may come as float32, which is too coarse for the
+    # optimiser's convergence tests
+    actual_colors = np.asarray(actual_colors, dtype=np.float64)
+    # start from the identity correction
     if algorithm == "classic_gamma_correction":
         color_alpha = np.ones([3, 1])
+        alpha_bounds = (-np.inf, np.inf)
     elif algorithm == "gamma_correction":
         color_alpha = np.eye(3)
+        alpha_bounds = ALPHA_BOUNDS
     else:
         raise ValueError("Unsupported algorithm {}.".format(algorithm))
 
@@ -170,10 +287,20 @@ def get_color_correction_parameters(true_colors, actual_colors,
     args_init = np.concatenate((color_alpha.reshape([color_alpha.size]),
                                 color_constant.reshape([color_constant.size]),
                                 color_gamma.reshape([color_gamma.size])))
-    args_refined, _ = \
-        optimize.leastsq(_get_color_error, args_init,
-                         args=(true_colors, actual_colors, algorithm),
-                         maxfev = 20000)
+    bounds_lower = np.concatenate((np.full(color_alpha.size, alpha_bounds[0]),
+                                   np.full(3, CONSTANT_BOUNDS[0]),
+                                   np.full(3, GAMMA_BOUNDS[0])))
+    bounds_upper = np.concatenate((np.full(color_alpha.size, alpha_bounds[1]),
+                                   np.full(3, CONSTANT_BOUNDS[1]),
+                                   np.full(3, GAMMA_BOUNDS[1])))
+    result = optimize.least_squares(_get_color_residuals, args_init,
+                                    jac=_get_color_jacobian,
+                                    bounds=(bounds_lower, bounds_upper),
+                                    method='trf', x_scale='jac',
+                                    args=(true_colors, actual_colors,
+                                          algorithm),
+                                    max_nfev=MAX_ITERATIONS)
+    args_refined = result.x
 
     if algorithm == "classic_gamma_correction":
         color_alpha = args_refined[:3].reshape([3, 1])
@@ -206,24 +333,33 @@ def get_colorcard_colors(color_card, grid_size):
     -------
     colors : 3xN ndarray
         List of colors with color channels go along the first array axis.
+    colors_std : ndarray
+        Sum over color channels of the standard deviation within each square.
     """
     grid_cols, grid_rows = grid_size
-    colors = np.zeros([3, grid_rows * grid_cols])
-    colors_std = np.zeros(grid_rows * grid_cols)
-
-    sample_size_row = int(0.2 * color_card.shape[0] / grid_rows)
-    sample_size_col = int(0.2 * color_card.shape[1] / grid_cols)
-    for row in range(grid_rows):
-        for col in range(grid_cols):
-            r = int((row + 0.5) * color_card.shape[0] / grid_rows)
-            c = int((col + 0.5) * color_card.shape[1] / grid_cols)
-            i = row * grid_cols + col
-            for j in range(colors.shape[0]):
-                channel = color_card[r - sample_size_row:r + sample_size_row,
-                                     c - sample_size_col:c + sample_size_col,
-                                     j]
-                colors[j, i] = np.median(channel.astype(np.float))
-                colors_std[i] = colors_std[i] + np.std(channel.astype(np.float))
+    height, width = color_card.shape[:2]
+
+    sample_size_row = int(0.2 * height / grid_rows)
+    sample_size_col = int(0.2 * width / grid_cols)
+    # centres of the squares, then the pixel indices of the sampled window
+    # around each centre
+    rows = ((np.arange(grid_rows) + 0.5) * height / grid_rows).astype(int)
+    cols = ((np.arange(grid_cols) + 0.5) * width / grid_cols).astype(int)
+    rows = rows[:, np.newaxis] + np.arange(-sample_size_row, sample_size_row)
+    cols = cols[:, np.newaxis] + np.arange(-sample_size_col, sample_size_col)
+    # [grid_rows * grid_cols, pixels per square, 3], squares ordered row by
+    # row, kept in the dtype of the image
+    patches = color_card[rows[:, np.newaxis, :, np.newaxis],
+                         cols[np.newaxis, :, np.newaxis, :]]
+    num_pixels = 4 * sample_size_row * sample_size_col
+    patches = patches.reshape([grid_rows * grid_cols, num_pixels,
+                               color_card.shape[2]])
+
+    # the median only needs the two middle values of a partial sort
+    middle = [(num_pixels - 1) // 2, num_pixels // 2]
+    partitioned = np.partition(patches, middle, axis=1)
+    colors = partitioned[:, middle, :].mean(axis=1, dtype=np.float32).T
+    colors_std = np.std(patches, axis=1, dtype=np.float32).sum(-1)
 
     return colors, colors_std
 
@@ -258,25 +394,31 @@ def correct_color(image, color_alpha, color_constant, color_gamma,
         If the input algorithm is not supported.
     
     """
-    # first turn it to [M*N, 3] matrix, then [3,M*N] matrix
     assert(len(image.shape) == 3)
-    colors = image.reshape([image.shape[0] * image.shape[1], 3])
-    colors = colors.transpose()
-
+    if algorithm == "gamma_correction" and image.dtype == np.uint8:
+        return _gamma_correction_lut(image, color_alpha, color_constant,
+                                     color_gamma)
+
+    # same models as `_classic_gamma_correction_model` and
+    # `_gamma_correction_model`, but applied along the last axis of the
+    # [M, N, 3] image so that it is never transposed
+    image = image.astype(np.float32)
+    color_constant = color_constant.reshape(3).astype(np.float32)
+    color_gamma = color_gamma.reshape(3).astype(np.float32)
     if algorithm == "classic_gamma_correction":
-        corrected_colors = \
-            _classic_gamma_correction_model(colors, color_alpha,
-                                            color_constant, color_gamma)
+        corrected_image = np.power(image, color_gamma)
+        corrected_image *= color_alpha.reshape(3).astype(np.float32)
+        corrected_image += color_constant
     elif algorithm == "gamma_correction":
-        corrected_colors = \
-            _gamma_correction_model(colors, color_alpha,
-                                    color_constant, color_gamma)
+        # alpha * pixel + beta with OpenCV's per-pixel 3x4 transform
+        matrix = np.hstack([color_alpha, color_constant.reshape([3, 1])])
+        corrected_image = cv2.transform(image, matrix.astype(np.float32))
+        cv2.max(corrected_image, 0, corrected_image)
+        corrected_image *= 1.0 / 255.0
+        np.power(corrected_image, color_gamma, out=corrected_image)
+        corrected_image *= 255.0
     else:
         raise ValueError("Unsupported algorithm {}.".format(algorithm))
 
-    # now turn it back to [M*N, 3] matrix, then [M,N,3] matrix
-    corrected_colors = corrected_colors.transpose()
-    corrected_image = corrected_colors.reshape([image.shape[0],
-                                                image.shape[1], 3])
-    corrected_image = np.clip(corrected_image, 0, 255).astype(np.uint8)
-    return corrected_image
+    np.clip(corrected_image, 0, 255, corrected_image)
+    return corrected_image.astype(np.uint8)
@@ -26,6 +26,27 @@ def rotate(image, angle, center = None, scale = 1.0):
 	# Return the rotated image
 	return rotated
 
+def rotate_bound(image, angle, inter = cv2.INTER_LINEAR):
+	# Grab the dimensions of the image and its center
+	(h, w) = image.shape[:2]
+	(cX, cY) = ((w - 1) / 2.0, (h - 1) / 2.0)
+
+	# Rotate about the center, enlarging the output to the
+	# bounding box of the rotated image so no corner is cut off
+	M = cv2.getRotationMatrix2D((cX, cY), angle, 1.0)
+	cos = np.abs(M[0, 0])
+	sin = np.abs(M[0, 1])
+	nW = int((h * sin) + (w * cos))
+	nH = int((h * cos) + (w * sin))
+	M[0, 2] += (nW - 1) / 2.0 - cX
+	M[1, 2] += (nH - 1) / 2.0 - cY
+
+	# Perform the rotation
+	rotated = cv2.warpAffine(image, M, (nW, nH), flags = inter)
+
+	# Return the rotated image
+	return rotated
+
 def resize(image, width = None, height = None, inter = cv2.INTER_AREA):
 	# initialize the dimensions of the image to be resized and
 	# grab the image size
@@ -23,24 +23,40 @@
 
 import numpy as np
 import os
+import ast
 import cv2
-import matplotlib.pylab as plt
-from Detect_colorChecker import detect_card
+from Detect_colorChecker import detect_card, template_pyramid
 from docopt import docopt
-from Color_correction import Color_correct_and_write
+from Color_correction import Color_correct_and_write, wait_for_writes, JPEG_QUALITY
 import time
 import multiprocessing
 import logging
+import logging.handlers
 
 
 NUM_CORES = multiprocessing.cpu_count()
 
+logger = logging.getLogger('color_correction')
+
+# Log.log lines keep the 'LEVEL:root:message' layout that logging.basicConfig
+# wrote before the named logger was used, so that tools reading existing logs
+# still parse them. 'root' is a fixed prefix, not the name of the logger.
+LOG_NAME_PREFIX = 'root'
+LOG_FORMAT = '%(levelname)s:' + LOG_NAME_PREFIX + ':%(message)s'
+
+# extensions of the images processed in the input folder
+IMG_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.tif', '.tiff'})
+
+# output buffer of resize_image for the last input shape, type and scale
+# (one per process)
+_RESIZE_CACHE = {}
+
 
 
 OPTS = """
 USAGE:
     run_color_correction -i INPUT -o OUTPUT -c CARD
-    run_color_correction -i INPUT -o OUTPUT -c CARD [-v] [(-t NUM_CORES)] [(-d DEGREE)]  [(-s SCALE)] [(-f CORD)] [(-n NAMES)] [(-l LOG)]
+    run_color_correction -i INPUT -o OUTPUT -c CARD [-v] [-a] [(-t NUM_CORES)] [(-d DEGREE)]  [(-s SCALE)] [(-f CORD)] [(-n NAMES)] [(-l LOG)] [(-q QUALITY)]
     
     run_color_correction -h | --help
 OPTIONS:
@@ -60,6 +76,9 @@ OPTIONS:
                     Coordinates of a point on the colorcard
                     x_cord: relevant to width, y_cord: relevant to height
     -v              Should be used if colorcard is portrait and image is landscape or vice versa
+    -a              Optional, approximate search of the scales and degrees: a coarse grid
+                    is searched first, then only around its best match. Faster for
+                    large "-s" and "-d" ranges, but may miss the best one
     -t NUM_CORES    Optional number of cores for parallel processing; 
                     Default value = all available cores
     -n NAMES        Optional, to modify output file name; NAMES = [old,new]
@@ -67,6 +86,8 @@ OPTIONS:
                     the file name, it is replaced with '-cor'
     -l LOG          Optional, enables writing logs into a file. LOG is the folder
                     where the log is saved
+    -q QUALITY      Optional, JPEG quality (0-100) of the corrected images;
+                    Default value = 95
 """
 
 def path_exists(x):
@@ -94,8 +115,8 @@ def file_exists(x):
         
 def string_array_check(str_array,length):
     """Validator for length of input array."""
-    array = eval(str_array)
-    if len(array) is length:
+    array = ast.literal_eval(str_array)
+    if len(array) == length:
         return(array)
     else:
         raise ValueError("number of variables in '%s' incorrect" % array)
@@ -112,7 +133,7 @@ def check_name_modification(names):
         #raise ValueError("incorrect format '%s', [] missing" % "".join(names))
     names = "".join(names)
     names_corrected = [x.strip() for x in names.split(',')]
-    if len(names_corrected) is 2:
+    if len(names_corrected) == 2:
         return(names_corrected[0], names_corrected[1])
     else:
         raise ValueError("number of variables in '%s' incorrect" % names)
@@ -134,10 +155,14 @@ def parse_options(opts):
                 'old_name' : '',
                 'new_name' : '',
                 'write_log' : False,
-                'log_folder' : ''
+                'log_folder' : '',
+                'jpeg_quality' : JPEG_QUALITY,
+                'coarse_to_fine' : False
               }
     if opts["-v"]:
         Options['vertical'] = True
+    if opts["-a"]:
+        Options['coarse_to_fine'] = True
     if opts["-s"] is not None:
         Scale = string_array_check(opts["-s"],3)
         if Scale[0] > 0 and Scale[1] > 0 and Scale[2] > 0:
@@ -170,29 +195,184 @@ def parse_options(opts):
     if opts["-l"] is not None:
         Options['write_log'] = True
         Options['log_folder'] = opts["-l"]
+    if opts["-q"] is not None:
+        Options['jpeg_quality'] = int(opts["-q"])
+        if not 0 <= Options['jpeg_quality'] <= 100:
+            raise ValueError("JPEG quality '%s' should be between 0 and 100" % opts["-q"])
 
     return(Options)
         
 def crop_image(image_orig,height_card,width_card,x_cord,y_cord):
-    x_start = max(0,x_cord - int(width_card*1.25))
-    y_start = max(0,y_cord - int(height_card*1.25))
-    x_end = min(np.size(image_orig,1)-1,x_cord + int(width_card*1.25))
-    y_end = min(np.size(image_orig,0)-1,y_cord + int(height_card*1.25))
-    image_cropped = image_orig[y_start:y_end,x_start:x_end,:]
-    if np.size(image_cropped,0) < height_card or np.size(image_cropped,1) < width_card:
-        print("Colorcard coordinate provided for fast mode incorrect. Trying normal mode")
-        return(image_orig)
-    return(image_cropped)
+    # returns the cropped image, or the whole image and False if the
+    # coordinates don't leave room for the card
+    (height_image, width_image) = image_orig.shape[:2]
+    # coordinates given as floats are rounded down to a pixel
+    (x_cord, y_cord) = (int(x_cord), int(y_cord))
+    dx = int(width_card*1.25)
+    dy = int(height_card*1.25)
+    x_start = max(0,x_cord - dx)
+    y_start = max(0,y_cord - dy)
+    x_end = min(width_image-1,x_cord + dx)
+    y_end = min(height_image-1,y_cord + dy)
+    image_cropped = image_orig[y_start:y_end,x_start:x_end]
+    if image_cropped.shape[0] < height_card or image_cropped.shape[1] < width_card:
+        return(image_orig, False)
+    return(image_cropped, True)
 
     
 def handle_verical_horizontal_cards(image_resized,vertical):
     height_image = np.size(image_resized,0)
     width_image = np.size(image_resized,1)
-    if (height_image > width_image) & (vertical is False):
-        image_resized = np.rot90(image_resized)
-    if (height_image < width_image) & (vertical is True):
-        image_resized = np.rot90(image_resized)
+    if height_image > width_image and vertical is False:
+        image_resized = cv2.rotate(image_resized, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    if height_image < width_image and vertical is True:
+        image_resized = cv2.rotate(image_resized, cv2.ROTATE_90_COUNTERCLOCKWISE)
     return(image_resized)
+
+def read_card(card_path, card_height):
+    # The card is only used at card_height pixels, so it is decoded at the
+    # largest JPEG reduction (8, 4 or 2) that keeps its short side at least
+    # that long. Returns the grayscale card and the reduction.
+    card = cv2.imread(card_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    # the 1/8 decode rounds each side up, so this is a lower bound of the
+    # full short side
+    short_side = (min(card.shape[:2]) - 1) * 8 + 1
+    for reduction, flag in ((8, None), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4), (2, cv2.IMREAD_REDUCED_GRAYSCALE_2), (1, cv2.IMREAD_GRAYSCALE)):
+        if short_side >= card_height * reduction:
+            break
+    if flag is not None:
+        card = cv2.imread(card_path, flag)
+    return(card, reduction)
+
+def resize_image(image, scale):
+    # Images of the same size are resized into the same buffer, as most inputs
+    # share one size. Only the buffer of the last size is kept, and the result
+    # is only valid until the next image is resized.
+    key = (image.shape, image.dtype.str, scale)
+    dst = _RESIZE_CACHE.get(key)
+    if dst is None:
+        _RESIZE_CACHE.clear()
+        dst = _RESIZE_CACHE[key] = cv2.resize(image,(0,0), fx=scale, fy=scale)
+        return(dst)
+    return(cv2.resize(image,(0,0), dst=dst, fx=scale, fy=scale))
+    
+        
+def iter_images(input_dir, output_dir):
+    # Yields (image path, output folder, file name) for the images under
+    # input_dir, the output folders mirroring the input tree under output_dir.
+    # Entry types come from the directory listing, without a stat per file.
+    # As with os.walk, folders that can't be listed (unreadable, or removed
+    # meanwhile) are skipped.
+    try:
+        with os.scandir(input_dir) as it:
+            entries = list(it)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_images(entry.path, os.path.join(output_dir, entry.name))
+        elif entry.name[entry.name.rfind('.'):].lower() in IMG_EXTS and entry.is_file():
+            yield (entry.path, output_dir, entry.name)
+
+def prepare_image(image_orig, Options, scale, height_card, width_card):
+    # The image searched for the card: cropped around the card in fast mode,
+    # scaled so that the card matches the template, and turned to the
+    # orientation of the template. It is turned after resizing, on the small image.
+    # Also returns whether the image could be cropped.
+    cropped = False
+    if Options['fast']:
+        image_cropped, cropped = crop_image(image_orig, height_card, width_card, Options['cord_x'], Options['cord_y'])
+    else:
+        image_cropped = image_orig
+    image_resized = resize_image(image_cropped, scale)
+    return(handle_verical_horizontal_cards(image_resized,Options['vertical']), cropped)
+
+def _process_one(args):
+    # Processes one image; what would be printed and logged is returned
+    # instead, so that messages of images processed in parallel don't mix
+    (fp, full_output_name, card, card_pyr, scale, height_card, width_card, Options, scale_search_range, degree_search_range, num_cores) = args
+    messages = []
+    logs = []
+    write = None
+    t = time.time()
+    logs.append((logging.INFO, ' Image %s found!', (fp,)))
+
+    messages.append(f'\n\nProcessing {fp}')
+    messages.append('-- Reading image...')
+    # decoded at full resolution: the card is searched for on a downscaled
+    # copy, but the whole image is color corrected and written at full size
+    image_orig = cv2.imread(fp)
+    if Options['fast']:
+        messages.append('-- Cropping image for faster analysis...')
+    image_resized, cropped = prepare_image(image_orig, Options, scale, height_card, width_card)
+    if Options['fast'] and not cropped:
+        messages.append("Colorcard coordinate provided for fast mode incorrect. Trying normal mode")
+    #t = time.time()
+    messages.append('-- Detecting Colorcard...')
+    Detected_card, Acc, SCALE = detect_card(image_resized,card,scale_search_range, degree_search_range, num_cores, card_pyr, Options['coarse_to_fine'])
+    messages.append(f'   Detection accuracy = {Acc*100:.2f} %')
+    logs.append((logging.INFO, '      Detection accuracy = %.2f %%', (Acc*100,)))
+    if Acc > 0.3:
+        card_damaged, card_rotated, correction_error, write = Color_correct_and_write(Detected_card,image_orig,full_output_name, Acc, Options['jpeg_quality'])
+        if card_rotated:
+            # a detected card is rotated if the black sqaure is not in the lowest row
+            messages.append('   Detected card is rotated')
+            logs.append((logging.WARNING, '   Detected card is rotated', ()))
+
+        if card_damaged:
+            messages.append('   Color card seems damaged')
+            messages.append('-- Skipping color correction')
+            logs.append((logging.WARNING, '   Color card seems damaged', ()))
+            logs.append((logging.ERROR, '     Color correction skipped \n', ()))
+        else:
+            messages.append('-- Correcting colors...')
+            messages.append(f'   Expected correction error = {correction_error} %')
+            logs.append((logging.INFO, '      Correction error = %s %%', (correction_error,)))
+            if correction_error < 50: 
+                # reported by _finish_write once the background write is done
+                write = (full_output_name, write)
+            else:
+                messages.append('   Image correction unsatisfactory!')
+                messages.append('   Writing of corrected image skipped')
+                logs.append((logging.WARNING, '   Image correction unsatisfactory!', ()))
+                logs.append((logging.ERROR, '     Writing of corrected image skipped \n', ()))
+    else:
+        messages.append('   Card detection unsatisfactory')
+        messages.append('-- Skipping color correction')
+        logs.append((logging.WARNING, '   Card detection unsatisfactory', ()))
+        logs.append((logging.ERROR, '     Color correction skipped \n', ()))
+
+    # print(t - time.time())
+    return(messages, logs, write)
+
+def _finish_write(result):
+    # Waits for the background write of the corrected image, if any, and
+    # reports whether it succeeded
+    messages, logs, write = result
+    if write is not None:
+        full_output_name, future = write
+        error = future.exception()
+        if error is None:
+            messages.append('-- Writing corrected image:')
+            messages.append(f'   {full_output_name}')
+            logs.append((logging.INFO, '      Corrected image written: \n                %s\n', (full_output_name,)))
+        else:
+            messages.append('-- Writing corrected image failed:')
+            messages.append(f'   {full_output_name}: {error}')
+            logs.append((logging.ERROR, '     Writing of corrected image failed: \n                %s: %s\n', (full_output_name, str(error))))
+    return(messages, logs, None)
+
+def _worker_init(num_threads):
+    # Each pool process gets its share of the cores, for OpenCV's own thread
+    # pool and for any BLAS/OpenMP library loaded from now on
+    cv2.setNumThreads(num_threads)
+    os.environ.setdefault('OMP_NUM_THREADS', str(num_threads))
+    os.environ.setdefault('OPENBLAS_NUM_THREADS', str(num_threads))
+
+def _process_one_in_worker(args):
+    # a pool worker finishes its background write before returning, as the
+    # future can't be sent back to the main process
+    return(_finish_write(_process_one(args)))
     
         
 def main(input_dir,output_dir,card_path,Options):
@@ -210,89 +390,85 @@ def main(input_dir,output_dir,card_path,Options):
         LOG_folder = path_exists2(Options['log_folder'])
         if LOG_folder:
             LOG_FILENAME = LOG_folder + 'Log.log'
-            logging.basicConfig(filename=LOG_FILENAME,level=logging.INFO)
+            # records are buffered and written in blocks, or as soon as an error is logged
+            log_file = logging.FileHandler(LOG_FILENAME)
+            log_file.setFormatter(logging.Formatter(LOG_FORMAT))
+            log_handler = logging.handlers.MemoryHandler(1024, target = log_file)
+            logger.addHandler(log_handler)
+            logger.setLevel(logging.INFO)
         else:
             Options['write_log'] = False
             print("\n\nLog folder '%s' not found! "% Options['log_folder'] )
             print('Writing logs disabled')
                   
             
-    card = cv2.imread(card_path,0)
     Default_card_h = 100
-    height_card = np.size(card,0)
-    width_card = np.size(card,1)
+    card, reduction = read_card(card_path, Default_card_h)
+    # sizes of the card at full resolution
+    height_card = np.size(card,0) * reduction
+    width_card = np.size(card,1) * reduction
     if height_card > width_card:
-        card = np.rot90(card)
+        card = cv2.rotate(card, cv2.ROTATE_90_COUNTERCLOCKWISE)
         height_card, width_card = width_card, height_card
     scale = Default_card_h/float(height_card)
  
-    card = cv2.resize(card,(0,0), fx=scale, fy=scale)
+    card = cv2.resize(card,(0,0), fx=scale*reduction, fy=scale*reduction, interpolation=cv2.INTER_AREA)
     card = cv2.Canny(card, 40, 50)
+    # the template pyramid only depends on the card, so it is built once for all images
+    card_pyr = template_pyramid(card)
+
+    # the list is needed up front to size the pool
+    images = []
+    for fp, output_dirpath, f in iter_images(input_dir, output_dir):
+        if Options['modify_name']:
+            full_output_name = os.path.join(output_dirpath,f.replace(Options['old_name'], Options['new_name']))
+        else:
+            full_output_name = os.path.join(output_dirpath,f)
+        images.append((fp, full_output_name))
+
+    # images are processed in parallel, one per process, and the cores left
+    # are shared by the card search of each image
+    num_cores = Options['num_cores']
+    if num_cores < 1:
+        num_cores = max(1, NUM_CORES + 1 + num_cores)
+    num_processes = max(1, min(num_cores, len(images)))
+    image_cores = max(1, num_cores // num_processes)
+    tasks = [(fp, full_output_name, card, card_pyr, scale, height_card, width_card, Options, scale_search_range, degree_search_range, image_cores)
+             for fp, full_output_name in images]
+
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes, initializer = _worker_init, initargs = (image_cores,))
+        results = pool.imap_unordered(_process_one_in_worker, tasks)
+    else:
+        pool = None
+        results = map(_process_one, tasks)
+    def report(result):
+        messages, logs, write = _finish_write(result)
+        for message in messages:
+            print(message)
+        if Options['write_log']:
+            for level, msg, args in logs:
+                logger.log(level, msg, *args)
+    try:
+        # an image is reported once the next one is processed, so that its
+        # background write overlaps with the next image
+        previous = None
+        for result in results:
+            if previous is not None:
+                report(previous)
+            previous = result
+        if previous is not None:
+            report(previous)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if Options['write_log']:
+            logger.removeHandler(log_handler)
+            log_handler.close()
+            log_file.close()
 
-    for dirpath, dirnames, filenames in os.walk(input_dir):
-        for f in filenames:
-            full_output_name = os.path.join(dirpath.replace(input_dir,output_dir),f.replace(Options['old_name'], Options['new_name']))
-            base, ext = os.path.splitext(f)
-            if ext.lower() in ['.jpg', '.png', '.tif', '.tiff']:
-                fp = os.path.join(dirpath, f)
-                t = time.time()
-                if Options['write_log']:
-                    logging.info(' Image %s found!',fp)
-
-                print('\n\nProcessing ' + fp)
-                print('-- Reading image...')
-                image_orig = cv2.imread(fp)
-                if Options['fast']:
-                    print('-- Cropping image for faster analysis...')
-                    image_cropped = crop_image(image_orig, height_card, width_card, Options['cord_x'], Options['cord_y'])
-                else:
-                    image_cropped = image_orig
-                image_resized = cv2.resize(image_cropped,(0,0), fx=scale, fy=scale)
-                image_resized = handle_verical_horizontal_cards(image_resized,Options['vertical'])
-                #t = time.time()
-                print('-- Detecting Colorcard...')
-                Detected_card, Acc, SCALE = detect_card(image_resized,card,scale_search_range, degree_search_range, Options['num_cores'])
-                print('   Detection accuracy = ' + str(round(Acc*10000)/float(100)) + ' %')
-                if Options['write_log']:
-                    logging.info('      Detection accuracy = ' + str(round(Acc*10000)/float(100)) + ' %')
-                if Acc > 0.3:
-                    card_damaged, card_rotated, correction_error = Color_correct_and_write(Detected_card,image_orig,full_output_name, Acc)
-                    if card_rotated:
-                        # a detected card is rotated if the black sqaure is not in the lowest row
-                        print('   Detected card is rotated')
-                        if Options['write_log']:
-                            logging.warning('   Detected card is rotated')
-
-                    if card_damaged:
-                        print('   Color card seems damaged')
-                        print('-- Skipping color correction')
-                        if Options['write_log']:
-                            logging.warning('   Color card seems damaged')
-                            logging.error('     Color correction skipped \n')
-                    else:
-                        print('-- Correcting colors...')
-                        print('   Expected correction error = ' + str(correction_error) + ' %')
-                        if Options['write_log']:
-                            logging.info('      Correction error = ' + str(correction_error) + ' %')
-                        if correction_error < 50: 
-                            print('-- Writing corrected image:')
-                            print('   ' + full_output_name)
-                            if Options['write_log']:
-                                logging.info('      Corrected image written: \n                ' + full_output_name + '\n')
-                        else:
-                            print('   Image correction unsatisfactory!')
-                            print('   Writing of corrected image skipped')
-                            if Options['write_log']:
-                                logging.warning('   Image correction unsatisfactory!')
-                                logging.error('     Writing of corrected image skipped \n')
-                else:
-                    print('   Card detection unsatisfactory')
-                    print('-- Skipping color correction')
-                    if Options['write_log']:
-                        logging.warning('   Card detection unsatisfactory')
-                        logging.error('     Color correction skipped \n')
-
-                # print(t - time.time())
+    wait_for_writes()
 
         
 if __name__ == '__main__':